@@ -1,8 +1,139 @@
-import json
+import orjson
+import zstandard
+import re
+from itertools import islice
+from functools import partial
 from tqdm import tqdm
-import subprocess
+import multiprocessing
+import mmap
+import stat
+import io
 import os
-from bertalign import Bertalign
+import sys
+import warnings
+from bertalign import Bertalign, model
+from bertalign.cache import EmbeddingCache, SplitCache
+from bertalign.corelib import warmup_align
+from bertalign.utils import clean_text, split_sents
+
+# matches the talk id of an output record without parsing the whole line
+TALK_ID_RE = re.compile(rb'"TALK-ID"\s*:\s*(-?\d+|"(?:[^"\\]|\\.)*")')
+
+def read_aligned_talks(output_file: str):
+    """
+    Scan the output file once, returning the ids of the talks already aligned.
+    Only needed for output files written before the .done sidecar existed.
+    """
+    aligned_talks = set()
+    with open(output_file, "rb") as f:
+        if output_file.endswith(".zst"):
+            f = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True))
+        for line in f:
+            match = TALK_ID_RE.search(line)
+            if match:
+                aligned_talks.add(orjson.loads(match.group(1)))
+    return aligned_talks
+
+def read_done_talks(done_file: str):
+    """
+    Read the .done sidecar, which holds one JSON [talk id, output size] pair
+    per line, the size being that of the output file once the talk was written.
+    Returns the ids of the talks already aligned and the last size recorded,
+    or None as the size if the sidecar is in an older format.
+    """
+    aligned_talks = set()
+    size = 0
+    with open(done_file, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = orjson.loads(line)
+            if not isinstance(entry, list):
+                return aligned_talks, None
+            talk_id, size = entry
+            aligned_talks.add(talk_id)
+    return aligned_talks, size
+
+def append_talk(fd: int, buf: bytes):
+    """
+    Append all the records of a talk to an O_APPEND descriptor with one
+    write call, looping only if the kernel accepts a short write. Each
+    write lands at the current end of the file, but a crash during a
+    short-write retry can still leave a partial talk.
+    """
+    view = memoryview(buf)
+    while view:
+        view = view[os.write(fd, view):]
+
+def iter_lines(fin):
+    """
+    Yield the lines of a file opened in binary mode through a read-only
+    memory map, so the feeder does not copy the file through Python buffers.
+    Pipes, FIFOs and other files that cannot be mapped are read as a stream.
+    """
+    st = os.fstat(fin.fileno())
+    if not stat.S_ISREG(st.st_mode):
+        yield from fin
+        return
+    if st.st_size == 0:
+        return
+    with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        yield from iter(mm.readline, b"")
+
+# sentence splits cache of the current preprocessing process
+worker_split_cache = None
+
+def init_preprocess(cache_dir):
+    """
+    Open the sentence splits cache in a preprocessing process.
+    """
+    global worker_split_cache
+    worker_split_cache = SplitCache(cache_dir) if cache_dir is not None else None
+
+def split_text(text: str, lang: str):
+    """
+    Split a transcript into sentences, one per line, reusing earlier splits
+    of the same text when the cache is enabled.
+    """
+    if worker_split_cache is not None:
+        sents = worker_split_cache.get(lang, text)
+        if sents is not None:
+            return sents
+    sents = "\n".join(split_sents(clean_text(text), lang))
+    if worker_split_cache is not None:
+        worker_split_cache.set(lang, text, sents)
+    return sents
+
+def preprocess_talk(line: bytes, src_lang: str, tgt_lang: str, gender: bool, is_split: bool):
+    """
+    Parse a talk and split both transcripts into sentences, one per line.
+    Runs in the preprocessing workers so that the main process only
+    encodes and aligns.
+    """
+    talk = orjson.loads(line)
+    src = talk['TRANSCRIPTS'][src_lang]
+    tgt = talk['TRANSCRIPTS'][tgt_lang]
+    if not is_split:
+        src = split_text(src, src_lang)
+        tgt = split_text(tgt, tgt_lang)
+    talk_gender = talk['GENDER'] if gender else None
+    return talk['TALK-ID'], talk['TALK-NAME'], talk_gender, src, tgt
+
+def preprocess_windows(pool, preprocess, lines, window: int):
+    """
+    Run preprocess over lines in the pool one window at a time, keeping at
+    most two windows in flight: the one being consumed and the next one
+    being split. This bounds how far the workers get ahead of the encoder.
+    """
+    results = None
+    while True:
+        chunk = list(islice(lines, window))
+        next_results = pool.imap(preprocess, chunk) if chunk else None
+        if results is not None:
+            yield from results
+        if next_results is None:
+            return
+        results = next_results
 
 def align_corpus(
     input_file: str,
@@ -18,76 +149,162 @@ def align_corpus(
     skip: float = -0.1,
     margin: bool = True,
     len_penalty: bool = True,
-    is_split: bool = False
+    is_split: bool = False,
+    emb_cache: bool = False,
+    split_cache: bool = True,
+    nb_preprocess: int = 2,
+    batch_talks: int = 8,
+    encode_batch_size: int = 32,
+    fp16: bool = False,
+    int8: bool = False,
+    encoder=None
 ):
 
-    # check if the output file exists
-    if not os.path.exists(output_file):
-        os.system(f"touch {output_file}")
+    # load the sentence encoder once and share it across all talks; the
+    # settings of this run go to a copy so the shared model is left as is
+    encoder = model if encoder is None else encoder
+    encoder = encoder.configure(batch_size=encode_batch_size, fp16=fp16, int8=int8)
 
-    total_talks = int(subprocess.run(["wc", "-l", output_file], capture_output=True, text=True, check=True).stdout.split()[0])
-    no_talks = total_talks if no_talks is None else no_talks
+    # the workers only split sentences and never touch the model, but they are
+    # forked from a process that has loaded torch, which is only safe on Linux
+    if nb_preprocess > 0 and not sys.platform.startswith("linux"):
+        warnings.warn("Preprocessing workers require fork on Linux; splitting sentences in the main process instead.")
+        nb_preprocess = 0
 
-    # read the output file to get the ids of talks already aligned
-    with open(output_file, "r") as f:
-        aligned_talks = set([json.loads(line)['TALK-ID'] for line in f])
+    # persist sentence embeddings next to the output file across runs
+    cache = EmbeddingCache(output_file + ".embcache") if emb_cache else None
+    split_cache_dir = output_file + ".embcache" if split_cache else None
 
-    initial_done = len(aligned_talks)
+    # open the output once for the whole run, creating it if needed
+    # (O_BINARY keeps Windows from translating newlines)
+    fout = os.open(output_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+    pool = None
+    try:
+        # compress each talk into its own zstd frame when writing to a .zst file;
+        # concatenated frames still decompress as one JSONL stream
+        compressor = zstandard.ZstdCompressor(level=3) if output_file.endswith(".zst") else None
 
-    # read the input file
-    with open(input_file, "r") as fin:
-        for idx, line in tqdm(enumerate(fin), total=offset + no_talks):
-            if idx < offset:
-                continue
+        # get the ids of talks already aligned from the sidecar next to the output,
+        # rebuilding it from the output file itself the first time or whenever it
+        # no longer matches the output (e.g. the output was deleted or truncated)
+        done_file = output_file + ".done"
+        output_size = os.fstat(fout).st_size
+        aligned_talks, done_size = read_done_talks(done_file) if os.path.exists(done_file) else (None, None)
+        if done_size != output_size:
+            aligned_talks = read_aligned_talks(output_file)
+            with open(done_file, "wb") as f:
+                f.writelines(orjson.dumps([talk_id, output_size]) + b"\n" for talk_id in aligned_talks)
 
-            talk = json.loads(line)
-            talk_id = talk['TALK-ID']
-            talk_name = talk['TALK-NAME']
-            talk_gender = talk['GENDER'] if gender else None
+        initial_done = len(aligned_talks)
+        # align every remaining talk unless told otherwise
+        max_done = None if no_talks is None else initial_done + no_talks
 
-            if talk_id in aligned_talks:
-                continue
+        # compile the DP kernels before the first talk instead of inside it
+        warmup_align(max_align=max_align, skip=skip, margin=margin, len_penalty=len_penalty)
 
-            src = talk['TRANSCRIPTS'][src_lang]
-            tgt = talk['TRANSCRIPTS'][tgt_lang]
-
-            # align the sentences
-            aligner = Bertalign(
-                src, tgt,
-                src_lang=src_lang,
-                tgt_lang=tgt_lang,
-                max_align=max_align,
-                top_k=top_k,
-                win=win,
-                skip=skip,
-                margin=margin,
-                len_penalty=len_penalty,
-                is_split=is_split
-            )
-
-            aligner.align_sents()
-
-            # write the aligned sentences to the output file
-            with open(output_file, "a") as fout:
-                for src, tgt in aligner.get_sentences():
-                    item = {"TALK-ID": talk_id, "TALK-NAME": talk_name}
-                    if gender:
-                        item['GENDER'] = talk_gender
-                    item[src_lang.upper()] = src
-                    item[tgt_lang.upper()] = tgt
-                    fout.write(json.dumps(item) + "\n")
+        # read the input file
+        with open(input_file, "rb") as fin, open(done_file, "ab") as fdone:
+            # skip the first offset talks and the ones already aligned before parsing them
+            def pending_talks():
+                for line in islice(iter_lines(fin), offset, None):
+                    match = TALK_ID_RE.search(line)
+                    if match and orjson.loads(match.group(1)) in aligned_talks:
+                        continue
+                    yield line
 
-            aligned_talks.add(talk_id)
+            preprocess = partial(preprocess_talk, src_lang=src_lang, tgt_lang=tgt_lang, gender=gender, is_split=is_split)
+
+            # split the sentences in worker processes while the main process runs the encoder,
+            # handing them a bounded window of talks at a time
+            if nb_preprocess > 0:
+                pool = multiprocessing.get_context("fork").Pool(nb_preprocess, initializer=init_preprocess, initargs=(split_cache_dir,))
+                talks = preprocess_windows(pool, preprocess, pending_talks(), batch_talks * nb_preprocess)
+            else:
+                init_preprocess(split_cache_dir)
+                talks = map(preprocess, pending_talks())
+
+            # talks waiting to be embedded together, by talk id
+            pending = {}
+
+            # count talks once they are written; the workers never report progress
+            pbar = tqdm(total=no_talks, mininterval=1.0, smoothing=0.1)
+
+            def align_pending():
+                # encode the sentences of all the pending talks in one go
+                Bertalign.embed_batch([aligner for _, _, aligner in pending.values()])
+
+                for talk_id, (talk_name, talk_gender, aligner) in pending.items():
+                    aligner.align_sents()
+
+                    # write the aligned sentences of the talk with a single system call
+                    lines = []
+                    for src, tgt in aligner.get_sentences():
+                        item = {"TALK-ID": talk_id, "TALK-NAME": talk_name}
+                        if gender:
+                            item['GENDER'] = talk_gender
+                        item[src_lang.upper()] = src
+                        item[tgt_lang.upper()] = tgt
+                        lines.append(orjson.dumps(item) + b"\n")
+                    buf = b"".join(lines)
+                    if compressor is not None:
+                        buf = compressor.compress(buf)
+                    append_talk(fout, buf)
+
+                    aligned_talks.add(talk_id)
+
+                    # only hit the disk at talk boundaries
+                    os.fsync(fout)
+
+                    # mark the talk as done only once its sentences are on disk,
+                    # along with the output size to check the sidecar against next time
+                    fdone.write(orjson.dumps([talk_id, os.fstat(fout).st_size]) + b"\n")
+                    fdone.flush()
+                    pbar.update(1)
+
+                pending.clear()
+
+            for talk_id, talk_name, talk_gender, src, tgt in talks:
+                if talk_id in aligned_talks or talk_id in pending:
+                    continue
+
+                # split the sentences now, embed them later with the rest of the batch
+                aligner = Bertalign.from_encoder(
+                    encoder, src, tgt,
+                    src_lang=src_lang,
+                    tgt_lang=tgt_lang,
+                    max_align=max_align,
+                    top_k=top_k,
+                    win=win,
+                    skip=skip,
+                    margin=margin,
+                    len_penalty=len_penalty,
+                    is_split=True,
+                    cache=cache,
+                    embed=False
+                )
+                pending[talk_id] = (talk_name, talk_gender, aligner)
+
+                if max_done is not None and len(aligned_talks) + len(pending) >= max_done:
+                    break
+
+                if len(pending) >= batch_talks:
+                    align_pending()
 
-            if len(aligned_talks) >= initial_done + no_talks:
-                break
+            align_pending()
+            pbar.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        os.close(fout)
+        if cache is not None:
+            cache.close()
 
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="Align the sentences in the input file using the bertalign model")
     parser.add_argument("--INPUT", type=str, help="The input file containing the sentences to align")
-    parser.add_argument("--OUTPUT", type=str, help="The output file to write the aligned sentences")
+    parser.add_argument("--OUTPUT", type=str, help="The output file to write the aligned sentences (zstd-compressed if it ends with .zst)")
     parser.add_argument("--GENDER", type=bool, default=False, help="The data containes gender information")
     parser.add_argument("--SRC_LANG", type=str, default="en", help="The source language")
     parser.add_argument("--TGT_LANG", type=str, default="es", help="The target language")
@@ -100,6 +317,13 @@ if __name__ == "__main__":
     parser.add_argument("--MARGIN", type=bool, default=True, help="The margin value")
     parser.add_argument("--LEN_PENALTY", type=bool, default=True, help="The length penalty value")
     parser.add_argument("--IS_SPLIT", type=bool, default=False, help="The split value")
+    parser.add_argument("--NB_PREPROCESS", type=int, default=2, help="The number of processes splitting the talks into sentences (Linux only)")
+    parser.add_argument("--BATCH_TALKS", type=int, default=8, help="The number of talks to embed together")
+    parser.add_argument("--ENCODE_BATCH_SIZE", type=int, default=32, help="The number of length-sorted sentences per encoder forward pass")
+    parser.add_argument("--FP16", action="store_true", help="Run the sentence encoder in half precision on GPU")
+    parser.add_argument("--INT8", action="store_true", help="Quantize the sentence encoder to int8 when running on CPU")
+    parser.add_argument("--EMB_CACHE", action="store_true", help="Cache the sentence embeddings next to the output file")
+    parser.add_argument("--NO_SPLIT_CACHE", action="store_true", help="Do not cache the sentence splits next to the output file")
 
     args = parser.parse_args()
 
@@ -117,5 +341,12 @@ if __name__ == "__main__":
         skip=args.SKIP,
         margin=args.MARGIN,
         len_penalty=args.LEN_PENALTY,
-        is_split=args.IS_SPLIT
+        is_split=args.IS_SPLIT,
+        emb_cache=args.EMB_CACHE,
+        split_cache=not args.NO_SPLIT_CACHE,
+        nb_preprocess=args.NB_PREPROCESS,
+        batch_talks=args.BATCH_TALKS,
+        encode_batch_size=args.ENCODE_BATCH_SIZE,
+        fp16=args.FP16,
+        int8=args.INT8
     )
\ No newline at end of file
@@ -15,8 +15,13 @@ class Bertalign:
                  margin=True,
                  len_penalty=True,
                  is_split=False,
+                 encoder=None,
+                 cache=None,
+                 embed=True,
                ):
         
+        self.encoder = model if encoder is None else encoder
+        self.cache = cache
         self.max_align = max_align
         self.top_k = top_k
         self.win = win
@@ -38,35 +43,68 @@ class Bertalign:
  
         src_num = len(src_sents)
         tgt_num = len(tgt_sents)
-        
+
+        src_code = src_lang
+        tgt_code = tgt_lang
         src_lang = LANG.ISO[src_lang]
         tgt_lang = LANG.ISO[tgt_lang]
         
         print("Source language: {}, Number of sentences: {}".format(src_lang, src_num))
         print("Target language: {}, Number of sentences: {}".format(tgt_lang, tgt_num))
 
-        print("Embedding source and target text using {} ...".format(model.model_name))
-        src_vecs, src_lens = model.transform(src_sents, max_align - 1)
-        tgt_vecs, tgt_lens = model.transform(tgt_sents, max_align - 1)
-
-        char_ratio = np.sum(src_lens[0,]) / np.sum(tgt_lens[0,])
-
         self.src_lang = src_lang
         self.tgt_lang = tgt_lang
+        self.src_code = src_code
+        self.tgt_code = tgt_code
         self.src_sents = src_sents
         self.tgt_sents = tgt_sents
         self.src_num = src_num
         self.tgt_num = tgt_num
+
+        # embedding can be deferred so that several texts are encoded together
+        if embed:
+            print("Embedding source and target text using {} ...".format(self.encoder.model_name))
+            Bertalign.embed_batch([self])
+
+    @staticmethod
+    def embed_batch(aligners):
+        """
+        Embed the source and target sentences of several aligners with one
+        encoder call per language. The aligners must share the same encoder,
+        cache and max_align.
+        """
+        if not aligners:
+            return
+
+        first = aligners[0]
+        batch = []
+        for aligner in aligners:
+            batch.append((aligner.src_sents, aligner.src_code))
+            batch.append((aligner.tgt_sents, aligner.tgt_code))
+        results = first.encoder.transform_batch(batch, first.max_align - 1, cache=first.cache)
+
+        for idx, aligner in enumerate(aligners):
+            src_vecs, src_lens = results[2 * idx]
+            tgt_vecs, tgt_lens = results[2 * idx + 1]
+            aligner.set_embeddings(src_vecs, src_lens, tgt_vecs, tgt_lens)
+
+    def set_embeddings(self, src_vecs, src_lens, tgt_vecs, tgt_lens):
         self.src_lens = src_lens
         self.tgt_lens = tgt_lens
-        self.char_ratio = char_ratio
+        self.char_ratio = np.sum(src_lens[0,]) / np.sum(tgt_lens[0,])
         self.src_vecs = src_vecs
         self.tgt_vecs = tgt_vecs
+
+    @classmethod
+    def from_encoder(cls, encoder, src, tgt, **kwargs):
+        # Reuse an already loaded encoder so that batch jobs
+        # do not pay the model start-up cost for every text pair.
+        return cls(src, tgt, encoder=encoder, **kwargs)
         
     def align_sents(self):
 
         print("Performing first-step alignment ...")
-        D, I = find_top_k_sents(self.src_vecs[0,:], self.tgt_vecs[0,:], k=self.top_k)
+        D, I = find_top_k_sents(self.src_vecs[0,:], self.tgt_vecs[0,:], k=self.top_k, fp16=self.encoder.fp16)
         first_alignment_types = get_alignment_types(2) # 0-1, 1-0, 1-1
         first_w, first_path = find_first_search_path(self.src_num, self.tgt_num)
         first_pointers = first_pass_align(self.src_num, self.tgt_num, first_w, first_path, first_alignment_types, D, I)
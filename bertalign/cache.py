@@ -0,0 +1,50 @@
+import hashlib
+import diskcache
+
+class EmbeddingCache:
+    """
+    Persistent store of sentence embeddings keyed by (tag, lang, sha1(sentence)),
+    so that sentences repeated across texts are only encoded once. The tag
+    identifies the encoder (model and precision) that produced the vectors.
+    Only single sentences are meant to be stored: at ~3 KB per LaBSE vector,
+    the default 4 GB size_limit holds well over a million of them.
+    """
+    def __init__(self, directory, size_limit=2**32):
+        self.cache = diskcache.Cache(directory, size_limit=size_limit)
+
+    @staticmethod
+    def key(tag, lang, line):
+        return (tag, lang, hashlib.sha1(line.encode("utf-8")).digest()[:16])
+
+    def get_many(self, tag, lang, lines):
+        return [self.cache.get(EmbeddingCache.key(tag, lang, line)) for line in lines]
+
+    def set_many(self, tag, lang, lines, vecs):
+        with self.cache.transact():
+            for line, vec in zip(lines, vecs):
+                self.cache.set(EmbeddingCache.key(tag, lang, line), vec)
+
+    def close(self):
+        self.cache.close()
+
+class SplitCache:
+    """
+    Persistent store of texts split into sentences keyed by (lang, sha1(text)),
+    so that re-running with different alignment parameters skips the splitter.
+    It can share its directory with an EmbeddingCache.
+    """
+    def __init__(self, directory):
+        self.cache = diskcache.Cache(directory)
+
+    @staticmethod
+    def key(lang, text):
+        return ("split", lang, hashlib.sha1(text.encode("utf-8")).digest()[:16])
+
+    def get(self, lang, text):
+        return self.cache.get(SplitCache.key(lang, text))
+
+    def set(self, lang, text, sents):
+        self.cache.set(SplitCache.key(lang, text), sents)
+
+    def close(self):
+        self.cache.close()
@@ -195,6 +195,33 @@ def calculate_length_penalty(src_lens,
 def nb_dot(x, y):
     return np.dot(x,y)
 
+def warmup_align(max_align=5, skip=-0.1, margin=True, len_penalty=True):
+    """
+    Run both DP passes on a tiny 2x2 input with the same argument types as
+    a real alignment, so that numba compiles (or loads from its cache) the
+    jitted kernels before the first text is aligned.
+    Args:
+        max_align: int. Maximum number of sentences in an alignment bead.
+        skip: float. Cost for instertion and deletion.
+        margin: boolean. True if choosing modified cosine similarity score.
+        len_penalty: boolean. True if applying the length penalty.
+    """
+    src_len, tgt_len = 2, 2
+    vecs = np.ones((max_align - 1, src_len, 4), dtype=np.float32)
+    lens = np.array([[1] * src_len] * (max_align - 1))
+    dist = np.ones((src_len, 1), dtype=np.float32)
+    index = np.zeros((src_len, 1), dtype=np.int64)
+
+    first_alignment_types = get_alignment_types(2)
+    first_w, first_path = find_first_search_path(src_len, tgt_len)
+    first_pass_align(src_len, tgt_len, first_w, first_path, first_alignment_types, dist, index)
+
+    second_alignment_types = get_alignment_types(max_align)
+    second_w, second_path = find_second_search_path([(1, 1), (2, 2)], 1, src_len, tgt_len)
+    char_ratio = np.sum(lens[0,]) / np.sum(lens[0,])
+    second_pass_align(vecs, vecs, lens, lens, second_w, second_path, second_alignment_types,
+                      char_ratio, skip, margin=margin, len_penalty=len_penalty)
+
 def find_second_search_path(align, w, src_len, tgt_len):
     """
     Convert 1-1 first-pass alignment to the second-round path.
@@ -377,22 +404,27 @@ def get_alignment_types(max_alignment_size):
                 alignment_types.append([x, y])    
     return np.array(alignment_types)
 
-def find_top_k_sents(src_vecs, tgt_vecs, k=3):
+def find_top_k_sents(src_vecs, tgt_vecs, k=3, fp16=False):
     """
     Find the top_k similar vecs in tgt_vecs for each vec in src_vecs.
     Args:
         src_vecs: numpy array of shape (num_src_sents, embedding_size).
         tgt_vecs: numpy array of shape (num_tgt_sents, embedding_size).
         k: int. Number of most similar target sentences.
+        fp16: boolean. True if the GPU index stores vectors in float16.
     Returns:
         D: numpy array. Similarity score matrix of shape (num_src_sents, k).
         I: numpy array. Target index matrix of shape (num_src_sents, k).
     """
     embedding_size = src_vecs.shape[1]
     if torch.cuda.is_available() and platform == 'linux': # GPU version
-        res = faiss.StandardGpuResources() 
+        res = _get_gpu_resources()
         index = faiss.IndexFlatIP(embedding_size)
-        gpu_index = faiss.index_cpu_to_gpu(res, 0, index)
+        # float16 storage lets the inner products run on tensor cores;
+        # faiss still returns the scores as float32.
+        co = faiss.GpuClonerOptions()
+        co.useFloat16 = fp16
+        gpu_index = faiss.index_cpu_to_gpu(res, 0, index, co)
         gpu_index.add(tgt_vecs) 
         D, I = gpu_index.search(src_vecs, k)
     else: # CPU version
@@ -400,3 +432,15 @@ def find_top_k_sents(src_vecs, tgt_vecs, k=3):
         index.add(tgt_vecs)
         D, I = index.search(src_vecs, k)
     return D, I
+
+_gpu_resources = None
+
+def _get_gpu_resources():
+    """
+    Create the faiss GPU resources once and reuse them for every search,
+    since allocating them reserves a large scratch buffer on the device.
+    """
+    global _gpu_resources
+    if _gpu_resources is None:
+        _gpu_resources = faiss.StandardGpuResources()
+    return _gpu_resources
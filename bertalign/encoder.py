@@ -1,24 +1,159 @@
+import copy
+import torch
+import warnings
 import numpy as np
 
 from sentence_transformers import SentenceTransformer
 from bertalign.utils import yield_overlaps
 
 class Encoder:
-    def __init__(self, model_name):
+    def __init__(self, model_name, batch_size=32, fp16=False, int8=False):
         self.model = SentenceTransformer(model_name)
         self.model_name = model_name
+        # the device the model runs on, even while configure() keeps it in host memory
+        self.device = self.model.device
+        self.batch_size = batch_size
+        self.fp16 = False
+        self.int8 = False
+        if fp16:
+            self.half()
+        if int8:
+            self.quantize()
 
-    def transform(self, sents, num_overlaps):
-        overlaps = []
-        for line in yield_overlaps(sents, num_overlaps):
-            overlaps.append(line)
+    def configure(self, batch_size=None, fp16=False, int8=False):
+        """
+        Return a new Encoder with the given settings, leaving the weights
+        of this one (e.g. the shared bertalign.model) untouched. The model
+        is only copied when it has to be converted to another precision.
+        For FP16 the FP32 model is moved to host memory and copied there,
+        and only the FP16 copy is put on the GPU, so the GPU holds half the
+        memory of the FP32 model at peak and afterwards. This encoder moves
+        its FP32 model back to the GPU the next time it encodes anything.
+        """
+        encoder = copy.copy(self)
+        if batch_size is not None:
+            encoder.batch_size = batch_size
+        if fp16 and self.device.type == "cuda":
+            self.model.to("cpu")
+            torch.cuda.empty_cache()
+            encoder.model = copy.deepcopy(self.model).half().to(self.device)
+            encoder.fp16 = True
+        elif fp16:
+            encoder.half()
+        if int8:
+            encoder.quantize()
+        return encoder
 
-        sent_vecs = self.model.encode(overlaps)
-        embedding_dim = sent_vecs.size // (len(sents) * num_overlaps)
-        sent_vecs.resize(num_overlaps, len(sents), embedding_dim)
+    def half(self):
+        # FP16 inference is only worth it on GPU; the embeddings are
+        # cast back to float32 so faiss and the DP are unaffected.
+        # This converts self.model in place, see configure() for a copy.
+        if self.device.type != "cuda":
+            warnings.warn("FP16 inference needs a CUDA device; keeping the encoder in FP32.")
+            return
+        self.model.half()
+        self.fp16 = True
 
-        len_vecs = [len(line.encode("utf-8")) for line in overlaps]
-        len_vecs = np.array(len_vecs)
-        len_vecs.resize(num_overlaps, len(sents))
+    def quantize(self):
+        # Dynamic int8 quantization of the linear layers speeds up
+        # CPU-only runs; it is not supported for CUDA tensors.
+        # The quantized model is a copy, the original model is not modified.
+        if self.device.type != "cpu":
+            warnings.warn("int8 quantization only applies on CPU; keeping the encoder unquantized.")
+            return
+        self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.int8 = True
 
-        return sent_vecs, len_vecs
+    @property
+    def cache_tag(self):
+        # vectors of another model or precision must never be mixed in the cache
+        return (self.model_name, self.fp16, self.int8)
+
+    def transform(self, sents, num_overlaps, lang=None, cache=None):
+        return self.transform_batch([(sents, lang)], num_overlaps, cache=cache)[0]
+
+    def transform_batch(self, batch, num_overlaps, cache=None):
+        """
+        Embed several texts at once.
+        Args:
+            batch: list of (sents, lang) tuples.
+            num_overlaps: int. Number of overlapping sentences to embed.
+            cache: EmbeddingCache or None.
+        Returns:
+            list of (sent_vecs, len_vecs) tuples, one per text in batch.
+        """
+        overlaps = [list(yield_overlaps(sents, num_overlaps)) for sents, _ in batch]
+
+        # run the model once per language on the overlaps of all the texts,
+        # then slice the embeddings of each text back out
+        sent_vecs = [None] * len(batch)
+        for lang in set(lang for _, lang in batch):
+            idxs = [idx for idx, (_, text_lang) in enumerate(batch) if text_lang == lang]
+            lines = [line for idx in idxs for line in overlaps[idx]]
+            if cache is None:
+                lang_vecs = self.encode(lines, lang=lang)
+            else:
+                # only single sentences repeat across texts, so only they go
+                # through the cache; the joined overlap windows are encoded directly
+                single = np.zeros(len(lines), dtype=bool)
+                start = 0
+                for idx in idxs:
+                    single[start:start + len(batch[idx][0])] = True
+                    start += len(overlaps[idx])
+                single_vecs = self.encode([line for line, is_single in zip(lines, single) if is_single], lang=lang, cache=cache)
+                lang_vecs = np.empty((len(lines), single_vecs.shape[1]), dtype=single_vecs.dtype)
+                lang_vecs[single] = single_vecs
+                if not single.all():
+                    lang_vecs[~single] = self.encode([line for line, is_single in zip(lines, single) if not is_single], lang=lang)
+            start = 0
+            for idx in idxs:
+                end = start + len(overlaps[idx])
+                sent_vecs[idx] = lang_vecs[start:end]
+                start = end
+
+        results = []
+        for (sents, _), vecs, lines in zip(batch, sent_vecs, overlaps):
+            embedding_dim = vecs.size // (len(sents) * num_overlaps)
+            vecs = vecs.reshape(num_overlaps, len(sents), embedding_dim)
+
+            len_vecs = [len(line.encode("utf-8")) for line in lines]
+            len_vecs = np.array(len_vecs)
+            len_vecs.resize(num_overlaps, len(sents))
+
+            results.append((vecs, len_vecs))
+
+        return results
+
+    @torch.inference_mode()
+    def _encode(self, lines):
+        # SentenceTransformer.encode sorts the lines by length before
+        # batching and restores the order afterwards, so each batch is
+        # only padded to the longest line of similar-length neighbours.
+        # inference_mode also skips the view and version tracking that
+        # no_grad still does.
+        if self.model.device != self.device:
+            self.model.to(self.device)
+        vecs = self.model.encode(lines, batch_size=self.batch_size)
+        return vecs.astype(np.float32, copy=False)
+
+    def encode(self, lines, lang=None, cache=None):
+        # encode every distinct line once (e.g. the PAD overlaps or
+        # repeated applause markers) and broadcast it back to its positions
+        uniq = {}
+        inverse = [uniq.setdefault(line, len(uniq)) for line in lines]
+        lines = list(uniq)
+
+        if cache is None:
+            return self._encode(lines)[inverse]
+
+        # only send the lines missing from the cache to the model
+        vecs = cache.get_many(self.cache_tag, lang, lines)
+        misses = [idx for idx, vec in enumerate(vecs) if vec is None]
+        if misses:
+            miss_lines = [lines[idx] for idx in misses]
+            miss_vecs = self._encode(miss_lines)
+            cache.set_many(self.cache_tag, lang, miss_lines, miss_vecs)
+            for idx, vec in zip(misses, miss_vecs):
+                vecs[idx] = vec
+
+        return np.stack(vecs)[inverse]
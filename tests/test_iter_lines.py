@@ -0,0 +1,41 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from align import iter_lines
+
+LINES = [b'{"TALK-ID": 1}\n', b'{"TALK-ID": 2}\n', b'{"TALK-ID": 3}']
+
+class IterLinesTest(unittest.TestCase):
+    def test_regular_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "in.jsonl")
+            with open(path, "wb") as f:
+                f.writelines(LINES)
+            with open(path, "rb") as fin:
+                self.assertEqual(list(iter_lines(fin)), LINES)
+
+    def test_empty_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "in.jsonl")
+            open(path, "wb").close()
+            with open(path, "rb") as fin:
+                self.assertEqual(list(iter_lines(fin)), [])
+
+    def test_pipe(self):
+        # e.g. --INPUT <(head -3 in.jsonl), which cannot be memory-mapped
+        read_fd, write_fd = os.pipe()
+
+        def feed():
+            with os.fdopen(write_fd, "wb") as f:
+                f.writelines(LINES)
+
+        writer = threading.Thread(target=feed)
+        writer.start()
+        with os.fdopen(read_fd, "rb") as fin:
+            self.assertEqual(list(iter_lines(fin)), LINES)
+        writer.join()
+
+if __name__ == "__main__":
+    unittest.main()